@@ -52,16 +52,25 @@ if __name__ == '__main__':
     try:
         response = client.read_response()
         assert response.type == 'OK', response
-        client.make_request(_common.Request('HELP'))
-        client.make_request(_common.Request('HELP GETINFO'))
+        requests = [
+            _common.Request('HELP'),
+            _common.Request('HELP GETINFO'),
+            ]
         for attribute in ['version', 'pid', 'socket_name', 'ssh_socket_name']:
+            requests.append(_common.Request('GETINFO', attribute))
+        client.send_requests(requests)
+        error = None
+        for request in requests:  # drain all responses before raising
             try:
-                client.make_request(_common.Request('GETINFO', attribute))
+                client.get_responses(requests=[request])
             except _error.AssuanError as e:
-                if e.message.startswith('No data'):
+                if (request.command == 'GETINFO' and
+                        e.message.startswith('No data')):
                     pass
-                else:
-                    raise
+                elif error is None:
+                    error = e
+        if error is not None:
+            raise error
     finally:
         client.make_request(_common.Request('BYE'))
         client.disconnect()
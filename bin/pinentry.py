@@ -19,11 +19,11 @@
 """Simple pinentry program for getting pins from a terminal.
 """
 
-import copy as _copy
+import locale as _locale
+import logging as _logging
 import os as _os
 import os.path as _os_path
 import pprint as _pprint
-import re as _re
 import signal as _signal
 import sys as _sys
 import termios as _termios
@@ -34,6 +34,15 @@ from pyassuan import common as _common
 from pyassuan import error as _error
 
 
+# termios line discipline while prompting: translate carriage return
+# to newline on input and do not ignore it; do not echo input
+# characters, but echo the NL character; enable canonical mode
+_IFLAG_SET = _termios.ICRNL
+_IFLAG_CLEAR = _termios.IGNCR
+_LFLAG_SET = _termios.ECHONL | _termios.ICANON
+_LFLAG_CLEAR = _termios.ECHO
+
+
 class PinEntry (_server.AssuanServer):
     """pinentry protocol server
 
@@ -93,15 +102,14 @@ class PinEntry (_server.AssuanServer):
       C: BYE
       S: OK closing connection
     """
-    _digit_regexp = _re.compile(r'\d+')
-
-    # from proc(5): pid comm state ppid pgrp session tty_nr tpgid
-    _tpgrp_regexp = _re.compile(r'\d+ \(\S+\) . \d+ \d+ \d+ \d+ (\d+)')
-
     def __init__(self, name='pinentry', strict_options=False,
                  single_request=True, **kwargs):
         self.strings = {}
         self.connection = {}
+        self._info = {  # GETINFO responses are constant for the process
+            'pid': str(_os.getpid()).encode('ascii'),
+            'version': __version__.encode('ascii'),
+            }
         super(PinEntry, self).__init__(
             name=name, strict_options=strict_options,
             single_request=single_request, **kwargs)
@@ -116,164 +124,174 @@ class PinEntry (_server.AssuanServer):
 
     def _connect(self):
         self.logger.info('connecting to user')
-        self.logger.debug('options:\n{}'.format(_pprint.pformat(self.options)))
+        if self.logger.isEnabledFor(_logging.DEBUG):
+            self.logger.debug('options:\n%s', _pprint.pformat(self.options))
         tty_name = self.options.get('ttyname', None)
         if tty_name:
-            self.connection['tpgrp'] = self._get_pgrp(tty_name)
-            self.logger.info(
-                'open to-user output stream for {}'.format(tty_name))
-            self.connection['to_user'] = open(tty_name, 'w')
-            self.logger.info(
-                'open from-user input stream for {}'.format(tty_name))
-            self.connection['from_user'] = open(tty_name, 'r')
+            self.logger.info('open to-user output stream for %s', tty_name)
+            self.connection['to_user'] = open(tty_name, 'wb')
+            self.logger.info('open from-user input stream for %s', tty_name)
+            self.connection['from_user'] = open(tty_name, 'rb')
+            try:
+                self.connection['tpgrp'] = _os.tcgetpgrp(
+                    self.connection['from_user'].fileno())
+            except OSError as e:
+                # tcgetpgrp only works on our controlling terminal
+                self.logger.info('tcgetpgrp failed: %s', e)
+                self.connection['tpgrp'] = self._get_pgrp(
+                    tty_name, rdev=_os.fstat(
+                        self.connection['from_user'].fileno()).st_rdev)
             self.logger.info('get current termios line discipline')
             self.connection['original termios'] = _termios.tcgetattr(
                 self.connection['to_user']) # [iflag, oflag, cflag, lflag, ...]
-            new_termios = _copy.deepcopy(self.connection['original termios'])
-            # translate carriage return to newline on input
-            new_termios[0] |= _termios.ICRNL
-            # do not ignore carriage return on input
-            new_termios[0] &= ~_termios.IGNCR
-            # do not echo input characters
-            new_termios[3] &= ~_termios.ECHO
-            # echo input characters
-            #new_termios[3] |= _termios.ECHO
-            # echo the NL character even if ECHO is not set
-            new_termios[3] |= _termios.ECHONL
-            # enable canonical mode
-            new_termios[3] |= _termios.ICANON
+            new_termios = list(self.connection['original termios'])
+            new_termios[6] = list(new_termios[6])  # cc, the only nested list
+            new_termios[0] = (new_termios[0] | _IFLAG_SET) & ~_IFLAG_CLEAR
+            new_termios[3] = (new_termios[3] | _LFLAG_SET) & ~_LFLAG_CLEAR
             self.logger.info('adjust termios line discipline')
             _termios.tcsetattr(
                 self.connection['to_user'], _termios.TCSANOW, new_termios)
-            self.logger.info('send SIGSTOP to pgrp {}'.format(
-                    self.connection['tpgrp']))
+            self.logger.info(
+                'send SIGSTOP to pgrp %d', self.connection['tpgrp'])
             #_os.killpg(self.connection['tpgrp'], _signal.SIGSTOP)
             _os.kill(-self.connection['tpgrp'], _signal.SIGSTOP)
             self.connection['tpgrp stopped'] = True
         else:
             self.logger.info('no TTY name given; use stdin/stdout for I/O')
-            self.connection['to_user'] = _sys.stdout
-            self.connection['from_user'] = _sys.stdin
+            self.connection['to_user'] = _sys.stdout.buffer
+            self.connection['from_user'] = _sys.stdin.buffer
+        # the terminal's encoding, as text-mode streams would have used
+        self.connection['encoding'] = _locale.getpreferredencoding(False)
         self.logger.info('connected to user')
-        self.connection['to_user'].write('\n')  # give a clean line to work on
         self.connection['active'] = True
 
     def _disconnect(self):
         self.logger.info('disconnecting from user')
+        connection = self.connection
         try:
-            if self.connection.get('original termios', None):
+            original_termios = connection.get('original termios')
+            if original_termios:
                 self.logger.info('restore original termios line discipline')
                 _termios.tcsetattr(
-                    self.connection['to_user'], _termios.TCSANOW,
-                    self.connection['original termios'])
-            if self.connection.get('tpgrp stopped', None) is True:
-                self.logger.info(
-                    'send SIGCONT to pgrp {}'.format(self.connection['tpgrp']))
-                #_os.killpg(self.connection['tpgrp'], _signal.SIGCONT)
-                _os.kill(-self.connection['tpgrp'], _signal.SIGCONT)
-            if self.connection.get('to_user', None) not in [None, _sys.stdout]:
+                    connection['to_user'], _termios.TCSANOW, original_termios)
+            if connection.get('tpgrp stopped') is True:
+                self.logger.info('send SIGCONT to pgrp %d', connection['tpgrp'])
+                #_os.killpg(connection['tpgrp'], _signal.SIGCONT)
+                _os.kill(-connection['tpgrp'], _signal.SIGCONT)
+            to_user = connection.get('to_user')
+            if to_user is not None and to_user is not _sys.stdout.buffer:
                 self.logger.info('close to-user output stream')
-                self.connection['to_user'].close()
-            if self.connection.get('from_user',None) not in [None,_sys.stdout]:
+                to_user.close()
+            from_user = connection.get('from_user')
+            if from_user is not None and from_user is not _sys.stdin.buffer:
                 self.logger.info('close from-user input stream')
-                self.connection['from_user'].close()
+                from_user.close()
         finally:
             self.connection = {'active': False}
             self.logger.info('disconnected from user')
 
-    def _get_pgrp(self, tty_name):
-        self.logger.info('find process group contolling {}'.format(tty_name))
-        proc = '/proc'
-        for name in _os.listdir(proc):
-            path = _os_path.join(proc, name)
-            if not (self._digit_regexp.match(name) and _os_path.isdir(path)):
+    def _get_pgrp(self, tty_name, rdev=None):
+        self.logger.info('find process group contolling %s', tty_name)
+        if rdev is None:
+            rdev = _os.stat(tty_name).st_rdev
+        major,minor = _os.major(rdev), _os.minor(rdev)
+        # the kernel's new_encode_dev(), as used for tty_nr in proc(5)
+        tty_nr = (minor & 0xff) | (major << 8) | ((minor & ~0xff) << 12)
+        for name in _os.listdir('/proc'):
+            if not name.isdigit():
                 continue  # not a process directory
-            self.logger.debug('checking process {}'.format(name))
-            fd_path = _os_path.join(path, 'fd', '0')
+            self.logger.debug('checking process %s', name)
+            stat_path = _os_path.join('/proc', name, 'stat')
             try:
-                link = _os.readlink(fd_path)
-            except OSError as e:
-                self.logger.debug('not our process: {}'.format(e))
-                continue  # permission denied (not one of our processes)
-            if link != tty_name:
-                self.logger.debug('wrong tty: {}'.format(link))
-                continue  # not attached to our target tty
-            stat_path = _os_path.join(path, 'stat')
-            stat = open(stat_path, 'r').read()
-            self.logger.debug('check stat for pgrp: {}'.format(stat))
-            match = self._tpgrp_regexp.match(stat)
-            assert match != None, stat
-            pgrp = int(match.group(1))
-            self.logger.info('found pgrp {} for {}'.format(pgrp, tty_name))
+                fd = _os.open(stat_path, _os.O_RDONLY)
+                try:
+                    stat = _os.read(fd, 512)  # only need the first fields
+                finally:
+                    _os.close(fd)
+            except OSError as e:  # ESRCH if it exits after the open
+                self.logger.debug('process vanished: %s', e)
+                continue
+            # from proc(5): pid (comm) state ppid pgrp session tty_nr
+            # tpgid ...  comm may contain spaces and parentheses, so
+            # split after the last ')'.
+            fields = stat[stat.rfind(b')')+2:].split(None, 6)
+            if len(fields) < 6:
+                self.logger.debug('truncated stat: %s', stat)
+                continue
+            if int(fields[4]) != tty_nr:
+                self.logger.debug('wrong tty: %s', stat)
+                continue  # not controlled by our target tty
+            pgrp = int(fields[5])
+            self.logger.info('found pgrp %d for %s', pgrp, tty_name)
             return pgrp
         raise ValueError(tty_name)
 
     def _write(self, string):
         "Write text to the user's terminal."
-        self.connection['to_user'].write(string + '\n')
+        self.connection['to_user'].write(
+            (string + '\n').encode(self.connection['encoding'], 'replace'))
         self.connection['to_user'].flush()
 
     def _read(self):
-        "Read and return a line from the user's terminal."
-        # drop trailing newline
-        return self.connection['from_user'].readline()[:-1]
+        "Read and return a line of raw bytes from the user's terminal."
+        return self.connection['from_user'].readline().rstrip(b'\n')
 
-    def _prompt(self, prompt='?', error=None, add_colon=True):
+    def _prompt(self, prompt='?', error=None, add_colon=True, lines=()):
+        "Show ``lines`` and the prompt in a single write and read a reply."
         if add_colon:
             prompt += ':'
+        lines = [''] + list(lines)  # start from a clean line
         if error:
-            self.connection['to_user'].write(error)
-            self.connection['to_user'].write('\n')
-        self.connection['to_user'].write(prompt)
-        self.connection['to_user'].write(' ')
+            lines.append(error)
+        lines.append(prompt + ' ')
+        self.connection['to_user'].write(
+            '\n'.join(lines).encode(self.connection['encoding'], 'replace'))
         self.connection['to_user'].flush()
         return self._read()
 
     # assuan handlers
 
     def _handle_GETINFO(self, arg):
-        if arg == 'pid':
-            yield _common.Response('D', str(_os.getpid()).encode('ascii'))
-        elif arg == 'version':
-            yield _common.Response('D', __version__.encode('ascii'))
-        else:
+        try:
+            data = self._info[arg]
+        except KeyError:
             raise _error.AssuanError(message='Invalid parameter')
-        yield _common.Response('OK')
+        return (_common.Response('D', data), _common.Response.OK)
 
     def _handle_SETKEYINFO(self, arg):
         self.strings['key info'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_CLEARPASSPHRASE(self, arg):
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETDESC(self, arg):
         self.strings['description'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETPROMPT(self, arg):
         self.strings['prompt'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETERROR(self, arg):
         self.strings['error'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETTITLE(self, arg):
         self.strings['title'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETOK(self, arg):
         self.strings['ok'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETCANCEL(self, arg):
         self.strings['cancel'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETNOTOK(self, arg):
         self.strings['not ok'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETQUALITYBAR(self, arg):
         """Adds a quality indicator to the GETPIN window.
@@ -306,58 +324,46 @@ class PinEntry (_server.AssuanServer):
             S: OK
         """
         self.strings['qualitybar'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_SETQUALITYBAR_TT(self, arg):
         self.strings['qualitybar_tooltip'] = arg
-        yield _common.Response('OK')
+        return self._OK
 
     def _handle_GETPIN(self, arg):
         try:
             self._connect()
-            self._write(self.strings['description'])
+            lines = [self.strings['description']]
             if 'key info' in self.strings:
-                self._write('key: {}'.format(self.strings['key info']))
+                lines.append('key: {}'.format(self.strings['key info']))
             if 'qualitybar' in self.strings:
-                self._write(self.strings['qualitybar'])
+                lines.append(self.strings['qualitybar'])
             pin = self._prompt(
                 prompt=self.strings['prompt'],
                 error=self.strings.get('error'),
-                add_colon=False)
+                add_colon=False, lines=lines)
         finally:
             self._disconnect()
-        yield _common.Response('D', pin.encode('ascii'))
-        yield _common.Response('OK')
+        return (_common.Response('D', pin), _common.Response.OK)
 
     def _handle_CONFIRM(self, arg):
+        one_button = arg == '--one-button'
         try:
             self._connect()
-            self._write(self.strings['description'])
-            self._write('1) '+self.strings['ok'])
-            self._write('2) '+self.strings['not ok'])
-            value = self._prompt('?')
+            menu = [self.strings['description'], '1) '+self.strings['ok']]
+            if not one_button:
+                menu.append('2) '+self.strings['not ok'])
+            value = self._prompt('?', lines=menu)
         finally:
             self._disconnect()
-        if value == '1':
-            yield _common.Response('OK')
+        if one_button or value == b'1':
+            return self._OK
         else:
             raise _error.AssuanError(message='Not confirmed')
 
     def _handle_MESSAGE(self, arg):
         self._write(self.strings['description'])
-        yield _common.Response('OK')
-
-    def _handle_CONFIRM(self, args):
-        assert args == '--one-button', args
-        try:
-            self._connect()
-            self._write(self.strings['description'])
-            self._write('1) '+self.strings['ok'])
-            value = self._prompt('?')
-        finally:
-            self._disconnect()
-        assert value == '1', value
-        yield _common.Response('OK')
+        return self._OK
 
 
 if __name__ == '__main__':
@@ -388,6 +394,5 @@ if __name__ == '__main__':
         p.run()
     except:
         p.logger.error(
-            'exiting due to exception:\n{}'.format(
-                traceback.format_exc().rstrip()))
+            'exiting due to exception:\n%s', traceback.format_exc().rstrip())
         raise
@@ -23,9 +23,20 @@ from . import common as _common
 from . import error as _error
 
 
+_PERCENT = ord('%')
+_EXPECT_OK = frozenset(['OK'])  # default final response type
+
+
 class AssuanClient (object):
     """A single-threaded Assuan client based on the `development suggestions`_
 
+    The connection stays open across requests until ``.disconnect()``.
+    Use the client as a context manager to disconnect on the way out::
+
+      with AssuanClient(name='client', close_on_disconnect=True) as client:
+          client.connect(socket_path=path)
+          ...
+
     .. _development suggestions:
       http://www.gnupg.org/documentation/manuals/assuan/Client-code.html
     """
@@ -40,12 +51,13 @@ class AssuanClient (object):
 
     def connect(self, socket_path=None):
         if socket_path:
-            self.logger.info(
-                'connect to Unix socket at {}'.format(socket_path))
+            self.logger.info('connect to Unix socket at %s', socket_path)
             self.socket = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
             self.socket.connect(socket_path)
-            self.input = self.socket.makefile('rb')
-            self.output = self.socket.makefile('wb')
+            self.input = self.socket.makefile(
+                'rb', buffering=_common.BUFFER_SIZE)
+            self.output = self.socket.makefile(
+                'wb', buffering=_common.BUFFER_SIZE)
         else:
             if not self.input:
                 self.logger.info('read from stdin')
@@ -68,6 +80,12 @@ class AssuanClient (object):
                 self.socket.close()
                 self.socket = None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.disconnect()
+
     def raise_error(self, error):
         self.logger.error(str(error))
         raise(error)
@@ -81,7 +99,7 @@ class AssuanClient (object):
             self.raise_error(
                 _error.AssuanError(message='Line too long'))
         if not line.endswith(b'\n'):
-            self.logger.info('S: {}'.format(line))
+            self.logger.info('S: %s', line)
             self.raise_error(
                 _error.AssuanError(message='Invalid response'))
         line = line[:-1]  # remove trailing newline
@@ -91,44 +109,56 @@ class AssuanClient (object):
         except _error.AssuanError as e:
             self.logger.error(str(e))
             raise
-        self.logger.info('S: {}'.format(response))
+        self.logger.info('S: %s', response)
         return response
 
-    def _write_request(self, request):
-        self.logger.info('C: {}'.format(request))
+    def _write_request(self, request, flush=True):
+        self.logger.info('C: %s', request)
         self.output.write(bytes(request))
         self.output.write(b'\n')
-        try:
-            self.output.flush()
-        except IOError:
-            raise        
+        if flush:
+            try:
+                self.output.flush()
+            except IOError:
+                raise
 
-    def make_request(self, request, response=True, expect=['OK']):
+    def make_request(self, request, response=True, expect=_EXPECT_OK):
         self._write_request(request=request)
         if response:
             return self.get_responses(requests=[request], expect=expect)
 
-    def get_responses(self, requests=None, expect=['OK']):
-        responses = list(self.responses())
-        if responses[-1].type == 'ERR':
-            eresponse = responses[-1]
-            fields = eresponse.parameters.split(' ', 1)
-            code = int(fields[0])
-            if len(fields) > 1:
-                message = fields[1].strip()
-            else:
-                message = None
+    def send_requests(self, requests):
+        """Pipeline ``requests`` to the server with a single flush.
+
+        The caller is responsible for reading the responses, with one
+        ``.get_responses()`` call per request in the order they were
+        sent.
+        """
+        for request in requests:
+            self._write_request(request=request, flush=False)
+        self.output.flush()
+
+    def get_responses(self, requests=None, expect=_EXPECT_OK):
+        responses = []
+        data = []
+        while True:
+            response = self.read_response()
+            responses.append(response)
+            if response.type == 'D':
+                data.append(response.parameters)
+            elif response.type not in {'S', '#'}:
+                break
+        if response.type == 'ERR':
+            code,_,message = response.parameters.partition(' ')
+            code = int(code)
+            message = message.strip() or None
             error = _error.AssuanError(code=code, message=message)
             if requests is not None:
                 error.requests = requests
             error.responses = responses
             raise error
         if expect:
-            assert responses[-1].type in expect, [str(r) for r in responses]
-        data = []
-        for response in responses:
-            if response.type == 'D':
-                data.append(response.parameters)
+            assert response.type in expect, [str(r) for r in responses]
         if data:
             data = b''.join(data)
         else:
@@ -139,32 +169,62 @@ class AssuanClient (object):
         while True:
             response = self.read_response()
             yield response
-            if response.type not in ['S', '#', 'D']:
+            if response.type not in {'S', '#', 'D'}:
                 break
 
-    def send_data(self, data=None, response=True, expect=['OK']):
-        """Iterate through requests necessary to send ``data`` to a server.
+    def send_data(self, data=None, response=True, expect=_EXPECT_OK):
+        r"""Iterate through requests necessary to send ``data`` to a server.
 
         http://www.gnupg.org/documentation/manuals/assuan/Client-requests.html
+
+        Long data is split over several D lines without breaking any
+        ``%XX`` escape.
+
+        >>> import io
+        >>> client = AssuanClient(name='test')
+        >>> client.input = io.BytesIO(b'OK\n')
+        >>> client.output = io.BytesIO()
+        >>> data = b'x' * 997 + b'%\n' + b'y' * 1000
+        >>> responses,_ = client.send_data(data)
+        >>> [str(response) for response in responses]
+        ['OK']
+        >>> lines = client.output.getvalue().split(b'\n')
+        >>> [len(line) for line in lines]
+        [999, 1000, 10, 3, 0]
+        >>> lines[0][-3:], lines[1][:5]
+        (b'xxx', b'D %25')
+        >>> lines[-2]
+        b'END'
+        >>> b''.join(_common.decode(line[2:]) for line in lines[:-2]) == data
+        True
         """
         requests = []
         if data:
-            encoded_data = _common.encode(data)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            encoded_data = memoryview(_common.encode(data))
+            length = len(encoded_data)
+            self.logger.debug('sending %d bytes of encoded data', length)
+            chunk_size = _common.LINE_LENGTH - 4  # 'D ', CR, LF
+            info = self.logger.isEnabledFor(_logging.INFO)
             start = 0
-            stop = min(_common.LINE_LENGTH-4, len(encoded_data)) # 'D ', CR, CL
-            self.logger.debug('sending {} bytes of encoded data'.format(
-                    len(encoded_data)))
-            while stop > start:
-                d = encoded_data[start:stop]
-                request = _common.Request(
-                    command='D', parameters=encoded_data[start:stop],
-                    encoded=True)
-                requests.append(request)
-                self.logger.debug('send {} byte chunk'.format(stop-start))
-                self._write_request(request=request)
+            while start < length:
+                stop = min(start + chunk_size, length)
+                if stop < length:  # do not split a %XX escape across lines
+                    if encoded_data[stop-1] == _PERCENT:
+                        stop -= 1
+                    elif encoded_data[stop-2] == _PERCENT:
+                        stop -= 2
+                chunk = encoded_data[start:stop]
+                requests.append(_common.Request(
+                    command='D', parameters=chunk, encoded=True))
+                if info:
+                    self.logger.info('C: D %s', bytes(chunk))
+                # buffered without flushing; END flushes the whole batch
+                self.output.write(b'D ')
+                self.output.write(chunk)
+                self.output.write(b'\n')
                 start = stop
-                stop = start + min(_common.LINE_LENGTH-4,
-                                   len(encoded_data) - start)
         request = _common.Request('END')
         requests.append(request)
         self._write_request(request=request)
@@ -175,7 +235,7 @@ class AssuanClient (object):
         """Send a file descriptor over a Unix socket.
         """
         msg = '# descriptors in flight: {}\n'.format(fds)
-        self.logger.info('C: {}'.format(msg.rstrip('\n')))
+        self.logger.info('C: %s', msg.rstrip('\n'))
         msg = msg.encode('ascii')
         return _common.send_fds(
             socket=self.socket, msg=msg, fds=fds, logger=None)
@@ -186,5 +246,5 @@ class AssuanClient (object):
         msg,fds = _common.receive_fds(
             socket=self.socket, msglen=msglen, maxfds=maxfds, logger=None)
         msg = str(msg, 'utf-8')
-        self.logger.info('S: {}'.format(msg.rstrip('\n')))
+        self.logger.info('S: %s', msg.rstrip('\n'))
         return fds
@@ -18,7 +18,6 @@
 """
 
 import array as _array
-import re as _re
 import socket as _socket
 
 from . import LOG as _LOG
@@ -26,12 +25,18 @@ from . import error as _error
 
 
 LINE_LENGTH = 1002  # 1000 + [CR,]LF
-_ENCODE_PATTERN = '(' + '|'.join(['%', '\r', '\n']) + ')'
-_ENCODE_STR_REGEXP = _re.compile(_ENCODE_PATTERN)
-_ENCODE_BYTE_REGEXP = _re.compile(_ENCODE_PATTERN.encode('ascii'))    
-_DECODE_STR_REGEXP = _re.compile('(%[0-9A-Fa-f]{2})')
-_DECODE_BYTE_REGEXP = _re.compile(b'(%[0-9A-Fa-f]{2})')
-_REQUEST_REGEXP = _re.compile('^(\w+)( *)(.*)\Z')
+BUFFER_SIZE = 65536  # for buffered socket streams
+_HEX_DIGITS = '0123456789ABCDEFabcdef'
+_COMMAND_CHARS = (
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_')
+_DECODE_STR_TABLE = dict(  # every case combination of 'XX' in '%XX'
+    (a + b, chr(int(a + b, 16)))
+    for a in _HEX_DIGITS for b in _HEX_DIGITS)
+_DECODE_BYTE_TABLE = dict(
+    (code.encode('ascii'), char.encode('latin-1'))
+    for code,char in _DECODE_STR_TABLE.items())
+_TO_HEX_STR_TABLE = ['%{:02X}'.format(i) for i in range(256)]
+_TO_HEX_BYTE_TABLE = [code.encode('ascii') for code in _TO_HEX_STR_TABLE]
 
 
 def encode(data):
@@ -41,13 +46,16 @@ def encode(data):
     'It grew by 5%25!%0A'
     >>> encode(b'It grew by 5%!\n')
     b'It grew by 5%25!%0A'
+    >>> encode(bytearray(b'5%\r\n'))
+    b'5%25%0D%0A'
     """
-    if isinstance(data, bytes):
-        regexp = _ENCODE_BYTE_REGEXP
-    else:
-        regexp = _ENCODE_STR_REGEXP
-    return regexp.sub(
-        lambda x : to_hex(x.group()), data)
+    # Only three characters are reserved, so a few C-level replace()
+    # passes beat a regexp with a Python callback per match.  '%' must
+    # go first, and clean data comes back without being copied.
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data).replace(
+            b'%', b'%25').replace(b'\r', b'%0D').replace(b'\n', b'%0A')
+    return data.replace('%', '%25').replace('\r', '%0D').replace('\n', '%0A')
 
 def decode(data):
     r"""
@@ -56,13 +64,34 @@ def decode(data):
     '"Look out!"\nWhere?'
     >>> decode(b'%22Look out!%22%0AWhere%3F')
     b'"Look out!"\nWhere?'
+    >>> decode(b'%c3%A9%Ff')
+    b'\xc3\xa9\xff'
+    >>> decode('100% sure, %4')
+    '100% sure, %4'
     """
-    if isinstance(data, bytes):
-        regexp = _DECODE_BYTE_REGEXP
-    else:
-        regexp = _DECODE_STR_REGEXP
-    return regexp.sub(
-        lambda x : from_hex(x.group()), data)
+    if isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+        if b'%' not in data:
+            return data  # nothing to unescape
+        return _decode(data, b'%', _DECODE_BYTE_TABLE)
+    if '%' not in data:
+        return data  # nothing to unescape
+    return _decode(data, '%', _DECODE_STR_TABLE)
+
+def _decode(data, percent, table):
+    """Unescape each '%XX' following a split on ``percent``
+
+    Anything after a '%' that is not two hex digits is kept as is.
+    """
+    parts = data.split(percent)
+    decoded = [parts[0]]
+    for part in parts[1:]:
+        char = table.get(part[:2])
+        if char is None:
+            decoded.append(percent + part)
+        else:
+            decoded.append(char + part[2:])
+    return percent[:0].join(decoded)
 
 def from_hex(code):
     r"""
@@ -73,11 +102,20 @@ def from_hex(code):
     '\n'
     >>> from_hex(b'%0A')
     b'\n'
+    >>> from_hex(b'%ff')
+    b'\xff'
+    >>> from_hex('%g0')
+    Traceback (most recent call last):
+      ...
+    ValueError: invalid percent escape: '%g0'
     """
-    c = chr(int(code[1:], 16))
-    if isinstance(code, bytes):
-        c =c.encode('ascii')
-    return c
+    try:
+        if isinstance(code, (bytes, bytearray)):
+            return _DECODE_BYTE_TABLE[bytes(code[1:])]
+        return _DECODE_STR_TABLE[code[1:]]
+    except KeyError:
+        message = 'invalid percent escape: {!r}'
+        raise ValueError(message.format(code)) from None
 
 def to_hex(char):
     r"""
@@ -88,11 +126,48 @@ def to_hex(char):
     '%0A'
     >>> to_hex(b'\n')
     b'%0A'
+
+    Only single bytes and characters up to U+00FF fit in one escape.
+
+    >>> to_hex('\u20ac')
+    Traceback (most recent call last):
+      ...
+    ValueError: cannot percent-encode U+20AC as a single byte
+    """
+    if isinstance(char, (bytes, bytearray)):
+        return _TO_HEX_BYTE_TABLE[char[0]]
+    try:
+        return _TO_HEX_STR_TABLE[ord(char)]
+    except IndexError:
+        message = 'cannot percent-encode U+{:04X} as a single byte'
+        raise ValueError(message.format(ord(char))) from None
+
+def _split_line(line, message):
+    r"""Split a request or response line into its command and parameters
+
+    The command must be a run of ASCII ``\w`` characters.  Parameters
+    are returned undecoded, or ``None`` if there are none.
+
+    >>> _split_line('OPTION  testing at 5%25', message='Invalid request')
+    ('OPTION', 'testing at 5%25')
+    >>> _split_line('BYE ', message='Invalid request')
+    ('BYE', None)
+    >>> _split_line('BYE\tnow', message='Invalid request')
+    Traceback (most recent call last):
+      ...
+    pyassuan.error.AssuanError: 170 Invalid request
+    >>> _split_line('B\xdcE', message='Invalid request')
+    Traceback (most recent call last):
+      ...
+    pyassuan.error.AssuanError: 170 Invalid request
     """
-    hx = '%{:02X}'.format(ord(char))
-    if isinstance(char, bytes):
-        hx = hx.encode('ascii')
-    return hx
+    command,space,parameters = line.partition(' ')
+    if not command or command.strip(_COMMAND_CHARS):
+        raise _error.AssuanError(message=message)
+    parameters = parameters.lstrip(' ')
+    if not parameters:
+        parameters = None
+    return (command, parameters)
 
 
 class Request (object):
@@ -108,6 +183,8 @@ class Request (object):
     'OPTION testing at 5%25'
     >>> bytes(r)
     b'OPTION testing at 5%25'
+    >>> bytes(Request(command='D', parameters=b'\\xff%\\n'))
+    b'D \\xff%25%0A'
     >>> r.from_bytes(b'BYE')
     >>> r.command
     'BYE'
@@ -127,6 +204,8 @@ class Request (object):
       ...
     pyassuan.error.AssuanError: 170 Invalid request
     """
+    __slots__ = ('command', 'parameters', 'encoded')
+
     def __init__(self, command=None, parameters=None, encoded=False):
         self.command = command
         self.parameters = parameters
@@ -138,34 +217,31 @@ class Request (object):
                 encoded_parameters = self.parameters
             else:
                 encoded_parameters = encode(self.parameters)
+            if not isinstance(encoded_parameters, (str, bytes)):
+                encoded_parameters = bytes(encoded_parameters)  # memoryview
             return '{} {}'.format(self.command, encoded_parameters)
         return self.command
 
     def __bytes__(self):
+        command = self.command.encode('utf-8')
         if self.parameters:
-            if self.encoded:
-                encoded_parameters = self.parameters
-            else:
-                encoded_parameters = encode(self.parameters)
-            return '{} {}'.format(
-                self.command, encoded_parameters).encode('utf-8')
-        return self.command.encode('utf-8')
+            parameters = self.parameters
+            if isinstance(parameters, str):
+                parameters = parameters.encode('utf-8')
+            if not self.encoded:
+                parameters = encode(parameters)
+            return b' '.join((command, parameters))
+        return command
 
     def from_bytes(self, line):
         if len(line) > 1000:  # TODO: byte-vs-str and newlines?
             raise _error.AssuanError(message='Line too long')
         line = str(line, encoding='utf-8')
-        match = _REQUEST_REGEXP.match(line)
-        if not match:
-            raise _error.AssuanError(message='Invalid request')
-        self.command = match.group(1)
-        if match.group(3):
-            if match.group(2):
-                self.parameters = decode(match.group(3))
-            else:
-                raise _error.AssuanError(message='Invalid request')
-        else:
-            self.parameters = None
+        self.command,parameters = _split_line(
+            line, message='Invalid request')
+        if parameters:
+            parameters = decode(parameters)
+        self.parameters = parameters
 
 
 class Response (object):
@@ -176,6 +252,8 @@ class Response (object):
     >>> r = Response(type='OK')
     >>> str(r)
     'OK'
+    >>> bytes(Response.OK)
+    b'OK'
     >>> r = Response(type='ERR', parameters='1 General error')
     >>> str(r)
     'ERR 1 General error'
@@ -199,7 +277,25 @@ class Response (object):
     Traceback (most recent call last):
       ...
     pyassuan.error.AssuanError: 76 Invalid response
+    >>> r.from_bytes(b'OOPS')
+    Traceback (most recent call last):
+      ...
+    pyassuan.error.AssuanError: 76 Invalid response
+    >>> r.from_bytes(b'D 5%25%0A')
+    >>> r.parameters
+    b'5%\\n'
+
+    Data is percent-encoded on the way out, so a passphrase such as
+    ``ab%41`` reaches the client as typed.
+
+    >>> bytes(Response(type='D', parameters=b'ab%41\\n'))
+    b'D ab%2541%0A'
+    >>> r.from_bytes(bytes(Response(type='D', parameters=b'ab%41')))
+    >>> r.parameters
+    b'ab%41'
     """
+    __slots__ = ('type', 'parameters')
+
     types = {
         'O': 'OK',
         'E': 'ERR',
@@ -221,7 +317,7 @@ class Response (object):
     def __bytes__(self):
         if self.parameters:
             if self.type == 'D':
-                return b' '.join((b'D', self.parameters))
+                return b'D ' + encode(self.parameters)
             else:
                 return '{} {}'.format(
                     self.type, encode(self.parameters)).encode('utf-8')
@@ -230,31 +326,28 @@ class Response (object):
     def from_bytes(self, line):
         if len(line) > 1000:  # TODO: byte-vs-str and newlines?
             raise _error.AssuanError(message='Line too long')
-        if line.startswith(b'D'):
-            self.command = t = 'D'
-        else:
-            line = str(line, encoding='utf-8')
-            t = line[0]
+        if line.startswith(b'D'):  # data stays bytes
+            self.type = 'D'
+            self.parameters = decode(line[2:])
+            return
+        line = str(line, encoding='utf-8')
         try:
-            type = self.types[t]
+            type = self.types[line[:1]]
         except KeyError:
             raise _error.AssuanError(message='Invalid response')
         self.type = type
-        if type == 'D':  # data
+        if type == '#':  # comment
             self.parameters = decode(line[2:])
-        elif type == '#':  # comment
-            self.parameters = decode(line[2:])
-        else:
-            match = _REQUEST_REGEXP.match(line)
-            if not match:
-                raise _error.AssuanError(message='Invalid request')
-            if match.group(3):
-                if match.group(2):
-                    self.parameters = decode(match.group(3))
-                else:
-                    raise _error.AssuanError(message='Invalid request')
-            else:
-                self.parameters = None
+            return
+        command,parameters = _split_line(line, message='Invalid response')
+        if command != type:
+            raise _error.AssuanError(message='Invalid response')
+        if parameters:
+            parameters = decode(parameters)
+        self.parameters = parameters
+
+# Shared instance for the common bare ``OK``.  Do not modify it.
+Response.OK = Response(type='OK')
 
 
 def error_response(error):
@@ -301,12 +394,12 @@ def receive_fds(socket, msglen=200, maxfds=10, logger=_LOG):
     """
     fds = _array.array('i')   # Array of ints
     msg,ancdata,flags,addr = socket.recvmsg(
-        msglen, _socket.CMSG_LEN(maxfds * fds.itemsize))
+        msglen, _socket.CMSG_SPACE(maxfds * fds.itemsize))
     for cmsg_level,cmsg_type,cmsg_data in ancdata:
         if (cmsg_level == _socket.SOL_SOCKET and
             cmsg_type == _socket.SCM_RIGHTS):
             # Append data, ignoring any truncated integers at the end.
-            fds.fromstring(
+            fds.frombytes(
                 cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
     if logger is not None:
         logger.debug('receiving file descriptors {} from {} ({})'.format(
@@ -15,7 +15,6 @@
 # pyassuan.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging as _logging
-import re as _re
 import socket as _socket
 import sys as _sys
 import threading as _threading
@@ -26,23 +25,37 @@ from . import common as _common
 from . import error as _error
 
 
-_OPTION_REGEXP = _re.compile('^-?-?([-\w]+)( *)(=?) *(.*?) *\Z')
+_OK_BYTES = bytes(_common.Response.OK)
+_OPTION_CHARS = _common._COMMAND_CHARS + '-'  # ASCII [-\w]
+
+
+def _reserved(self, arg):
+    """Reply to a reserved command that this server does not implement
+    """
+    raise _error.AssuanError(code=175, message='Unknown command (reserved)')
 
 
 class AssuanServer (object):
     """A single-threaded Assuan server based on the `devolpment suggestions`_
 
     Extend by subclassing and adding ``_handle_XXX`` methods for each
-    command you want to handle.
+    command you want to handle.  The handlers are collected into a
+    table the first time each class is instantiated.
+
+    >>> sorted(AssuanServer(name='test')._handlers)
+    ['AUTH', 'BYE', 'CANCEL', 'END', 'HELP', 'OPTION', 'QUIT', 'RESET']
 
     .. _development suggestions:
       http://www.gnupg.org/documentation/manuals/assuan/Server-code.html
     """
+    _OK = (_common.Response.OK,)  # shared reply for plain-OK handlers
+
     def __init__(self, name, logger=_LOG, use_sublogger=True,
                  valid_options=None, strict_options=True,
                  single_request=False, listen_to_quit=False,
                  close_on_disconnect=False):
         self.name = name
+        self._handlers = _get_handlers(type(self))
         if use_sublogger:
             logger = _logging.getLogger('{}.{}'.format(logger.name, self.name))
         self.logger = logger
@@ -85,62 +98,146 @@ class AssuanServer (object):
             self.input = None
             self.output = None
 
-    def handle_requests(self):        
+    def handle_requests(self):
+        r"""Read and answer requests until ``.stop`` is set or input ends
+
+        Overlong lines are skipped with an error, without losing the
+        requests that follow them.
+
+        >>> import io
+        >>> s = AssuanServer(name='test', single_request=True)
+        >>> s.input = io.BytesIO(
+        ...     b'OPTION ' + b'x' * _common.LINE_LENGTH + b'\nBYE\n')
+        >>> s.output = io.BytesIO()
+        >>> s.handle_requests()
+        >>> print(s.output.getvalue().decode('ascii'), end='')
+        OK Your orders please
+        ERR 97 Line too long
+        OK closing connection
+        """
         self.send_response(_common.Response('OK', 'Your orders please'))
-        self.output.flush()
+        # bind loop invariants once
+        readline = self.input.readline
+        line_length = _common.LINE_LENGTH
+        log = self.logger.info
+        send_error_response = self.send_error_response
+        handle_request = self.handle_request
+        Request = _common.Request
         while not self.stop:
-            line = self.input.readline()
+            line = readline(line_length + 1)
             if not line:
                 break  # EOF
-            if len(line) > _common.LINE_LENGTH:
-                self.raise_error(
+            if len(line) > line_length:
+                while line and not line.endswith(b'\n'):  # skip the rest
+                    line = readline(line_length)
+                send_error_response(
                     _error.AssuanError(message='Line too long'))
+                continue
             if not line.endswith(b'\n'):
-                self.logger.info('C: {}'.format(line))
-                self.send_error_response(
+                log('C: %s', line)
+                send_error_response(
                     _error.AssuanError(message='Invalid request'))
                 continue
             line = line[:-1]  # remove the trailing newline
-            self.logger.info('C: {}'.format(line))
-            request = _common.Request()
+            log('C: %s', line)
+            request = Request()
             try:
                 request.from_bytes(line)
             except _error.AssuanError as e:
-                self.send_error_response(e)
+                send_error_response(e)
                 continue
-            self.handle_request(request)
+            handle_request(request)
 
     def handle_request(self, request):
-        try:
-            handle = getattr(
-                self, '_handle_{}'.format(request.command))
-        except AttributeError:
-            self.logger.warn('unknown command: {}'.format(request.command))
+        r"""Dispatch ``request`` to its ``_handle_XXX`` method
+
+        Handlers returning a tuple or list have their responses sent in
+        one write.  Generator handlers have each response sent as it is
+        yielded, so they can read the client's reply to an INQUIRE.
+
+        >>> import socket, threading
+        >>> class Server (AssuanServer):
+        ...     def _handle_ASK(self, arg):
+        ...         yield _common.Response('INQUIRE', 'NAME')
+        ...         name = self.input.readline()[2:-1].decode('ascii')
+        ...         assert self.input.readline() == b'END\n'
+        ...         yield _common.Response('S', 'got {}'.format(name))
+        ...         yield _common.Response.OK
+        >>> a,b = socket.socketpair()
+        >>> b.settimeout(5)
+        >>> server = Server(name='test', single_request=True)
+        >>> server.input = a.makefile('rb')
+        >>> server.output = a.makefile('wb')
+        >>> thread = threading.Thread(
+        ...     target=server.handle_requests, daemon=True)
+        >>> thread.start()
+        >>> client = b.makefile('rwb')
+        >>> client.readline()
+        b'OK Your orders please\n'
+        >>> client.write(b'ASK\n')
+        4
+        >>> client.flush()
+        >>> client.readline()
+        b'INQUIRE NAME\n'
+        >>> client.write(b'D Alice\nEND\n')
+        12
+        >>> client.flush()
+        >>> client.readline()
+        b'S got Alice\n'
+        >>> client.readline()
+        b'OK\n'
+        >>> client.write(b'BYE\n')
+        4
+        >>> client.flush()
+        >>> client.readline()
+        b'OK closing connection\n'
+        >>> thread.join(5)
+        >>> for stream in [client, server.input, server.output, a, b]:
+        ...     stream.close()
+        """
+        handle = self._handlers.get(request.command)
+        if handle is None:
+            self.logger.warning('unknown command: %s', request.command)
             self.send_error_response(
                 _error.AssuanError(message='Unknown command'))
             return
         try:
-            responses = handle(request.parameters)
-            for response in responses:
-                self.send_response(response)
+            responses = handle(self, request.parameters)
+            if not isinstance(responses, (tuple, list)):
+                for response in responses:  # stream generators
+                    self.send_response(response)
+                return
         except _error.AssuanError as error:
             self.send_error_response(error)
             return
         except Exception as e:
             self.logger.error(
-                'exception while executing {}:\n{}'.format(
-                    handle, _traceback.format_exc().rstrip()))
+                'exception while executing %s:\n%s',
+                handle, _traceback.format_exc().rstrip())
             self.send_error_response(
                 _error.AssuanError(message='Unspecific Assuan server fault'))
             return
+        self.send_responses(responses)
 
     def send_response(self, response):
         """For internal use by ``.handle_requests()``
         """
-        rstring = str(response)
-        self.logger.info('S: {}'.format(response))
-        self.output.write(bytes(response))
-        self.output.write(b'\n')
+        self.send_responses([response])
+
+    def send_responses(self, responses):
+        """For internal use by ``.handle_requests()``
+
+        All of the responses go out in a single write and flush.
+        """
+        lines = []
+        for response in responses:
+            self.logger.info('S: %s', response)
+            if response is _common.Response.OK:
+                lines.append(_OK_BYTES)
+            else:
+                lines.append(bytes(response))
+        lines.append(b'')  # trailing newline
+        self.output.write(b'\n'.join(lines))
         try:
             self.output.flush()
         except IOError:
@@ -158,25 +255,20 @@ class AssuanServer (object):
     def _handle_BYE(self, arg):
         if self.single_request:
             self.stop = True
-        yield _common.Response('OK', 'closing connection')
+        return (_common.Response('OK', 'closing connection'),)
 
     def _handle_RESET(self, arg):
         self.reset()
+        return self._OK
 
-    def _handle_END(self, arg):
-        raise _error.AssuanError(
-            code=175, message='Unknown command (reserved)')
-
-    def _handle_HELP(self, arg):
-        raise _error.AssuanError(
-            code=175, message='Unknown command (reserved)')
+    _handle_END = _reserved
+    _handle_HELP = _reserved
 
     def _handle_QUIT(self, arg):
         if self.listen_to_quit:
             self.stop = True
-            yield _common.Response('OK', 'stopping the server')
-        raise _error.AssuanError(
-            code=175, message='Unknown command (reserved)')
+            return (_common.Response('OK', 'stopping the server'),)
+        return _reserved(self, arg)
 
     def _handle_OPTION(self, arg):
         """
@@ -206,32 +298,54 @@ class AssuanServer (object):
         Traceback (most recent call last):
           ...
         pyassuan.error.AssuanError: 90 Invalid parameter
+        >>> list(s._handle_OPTION('caf\\xe9'))
+        Traceback (most recent call last):
+          ...
+        pyassuan.error.AssuanError: 90 Invalid parameter
         """
-        match = _OPTION_REGEXP.match(arg)
-        if not match:
-            raise _error.AssuanError(message='Invalid parameter')
-        name,space,equal,value = match.groups()
-        if value and not space and not equal:
-            # need either space or equal to separate value
+        # the name ends at the first '=' or space, whichever comes first
+        name,sep,value = arg.partition('=')
+        if ' ' in name:
+            name,sep,value = arg.partition(' ')
+            value = value.lstrip(' ')
+            if value.startswith('='):
+                value = value[1:]
+        if name.startswith('--'):
+            name = name[2:]
+        elif name.startswith('-'):
+            name = name[1:]
+        if not name or name.strip(_OPTION_CHARS):
             raise _error.AssuanError(message='Invalid parameter')
+        value = value.strip(' ')
         if name not in self.valid_options:
             if self.strict_options:
                 raise _error.AssuanError(message='Unknown option')
             else:
-                self.logger.info('skipping invalid option: {}'.format(name))
+                self.logger.info('skipping invalid option: %s', name)
         else:
             if not value:
                 value = None
             self.options[name] = value
-        yield _common.Response('OK')
+        return self._OK
 
-    def _handle_CANCEL(self, arg):
-        raise _error.AssuanError(
-            code=175, message='Unknown command (reserved)')
+    _handle_CANCEL = _reserved
+    _handle_AUTH = _reserved
 
-    def _handle_AUTH(self, arg):
-        raise _error.AssuanError(
-            code=175, message='Unknown command (reserved)')
+
+_HANDLERS = {}  # cache of _get_handlers() tables, keyed by class
+
+def _get_handlers(cls):
+    """Map command names to ``_handle_XXX`` functions for ``cls``
+    """
+    handlers = _HANDLERS.get(cls)
+    if handlers is None:
+        handlers = {}
+        for base in reversed(cls.__mro__):
+            for name,value in vars(base).items():
+                if name.startswith('_handle_'):
+                    handlers[name[len('_handle_'):]] = value
+        _HANDLERS[cls] = handlers
+    return handlers
 
 
 class AssuanSocketServer (object):
@@ -257,7 +371,7 @@ class AssuanSocketServer (object):
             kwargs['close_on_disconnect'] = True
         self.kwargs = kwargs
         self.max_threads = max_threads
-        self.threads = []
+        self.threads = set()
 
     def run(self):
         self.logger.info('listen on socket')
@@ -265,35 +379,36 @@ class AssuanSocketServer (object):
         thread_index = 0
         while True:
             socket,address = self.socket.accept()
-            self.logger.info('connection from {}'.format(address))
+            self.logger.info('connection from %s', address)
             self.cleanup_threads()
-            if len(threads) > self.max_threads:
+            if len(self.threads) >= self.max_threads:
                 self.drop_connection(socket, address)
+                continue
             self.spawn_thread(
                 'server-thread-{}'.format(thread_index), socket, address)
             thread_index = (thread_index + 1) % self.max_threads
 
     def cleanup_threads(self):
-        i = 0
-        while i < len(self.threads):
-            thread = self.threads[i]
-            thread.join(0)
-            if thread.is_alive():
-                self.logger.info('joined thread {}'.format(thread.name))
-                self.threads.pop(i)
-                thread.socket.shutdown()
-                thread.socket.close()
-            else:
-                i += 1
+        for thread in [t for t in self.threads if not t.is_alive()]:
+            thread.join()
+            self.logger.info('joined thread %s', thread.name)
+            self.threads.discard(thread)
+            try:
+                thread.socket.shutdown(_socket.SHUT_RDWR)
+            except OSError:
+                pass  # the client already hung up
+            thread.socket.close()
 
     def drop_connection(self, socket, address):
-        self.logger.info('drop connection from {}'.format(address))
+        self.logger.info('drop connection from %s', address)
         # TODO: proper error to send to the client?
+        socket.close()
 
     def spawn_thread(self, name, socket, address):
         server = self.server(name=name, **self.kwargs)
-        server.input = socket.makefile('rb')
-        server.output = socket.makefile('wb')
+        server.input = socket.makefile('rb', buffering=_common.BUFFER_SIZE)
+        server.output = socket.makefile('wb', buffering=_common.BUFFER_SIZE)
         thread = _threading.Thread(target=server.run, name=name)
+        thread.socket = socket  # closed by .cleanup_threads()
         thread.start()
-        self.threads.append(thread)
+        self.threads.add(thread)